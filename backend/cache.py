@@ -0,0 +1,45 @@
+import os
+import time
+
+# In-process result cache. Entries are keyed by the current data version, so
+# bumping the version (e.g. after a load) invalidates everything at once; the
+# TTL covers writes that happen outside the API.
+CACHE_TTL = float(os.getenv("CACHE_TTL_SECONDS", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "512"))
+
+_data_version = 0
+_store = {}
+
+
+def data_version() -> int:
+    return _data_version
+
+
+def bump_data_version() -> int:
+    global _data_version
+    _data_version += 1
+    _store.clear()
+    return _data_version
+
+
+def cache_get(key):
+    entry = _store.get((_data_version, key))
+    if entry is None:
+        return None
+    expires, value = entry
+    if expires < time.monotonic():
+        _store.pop((_data_version, key), None)
+        return None
+    return value
+
+
+def cache_set(key, value, ttl: float = CACHE_TTL, version: int = None):
+    # version is data_version() from before the value was read; a value read
+    # across a bump may predate the new data and is returned but not stored.
+    if version is not None and version != _data_version:
+        return value
+    if len(_store) >= CACHE_MAX_ENTRIES:
+        # dicts keep insertion order, so this drops the oldest entry
+        _store.pop(next(iter(_store)))
+    _store[(_data_version, key)] = (time.monotonic() + ttl, value)
+    return value
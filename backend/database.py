@@ -1,39 +1,328 @@
 import os
+import time
+import math
+import asyncio
 import asyncpg
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
-_pool = None
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX", "10"))
+
+# Admission control. Every query runs in a lane; the heavy lane may only hold
+# part of each pool so interactive requests always find a free connection.
+# Waiting for a connection is bounded in time and in queue length.
+LANE_SLOTS = {
+    "interactive": POOL_MAX_SIZE,
+    "heavy": int(os.getenv("DB_HEAVY_SLOTS", str(max(1, POOL_MAX_SIZE - 4)))),
+}
+INTERACTIVE_TIMEOUT_MS = int(os.getenv("DB_INTERACTIVE_TIMEOUT_MS", "5000"))
+HEAVY_TIMEOUT_MS = int(os.getenv("DB_HEAVY_TIMEOUT_MS", "20000"))
+# Manual rollup rebuilds run in the heavy lane but may take minutes
+REFRESH_TIMEOUT_MS = int(os.getenv("DB_REFRESH_TIMEOUT_MS", "300000"))
+ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "2"))
+MAX_QUEUE = int(os.getenv("DB_MAX_QUEUE", "50"))
+
+# Read replicas, e.g. DB_REPLICA_HOSTS="10.0.0.2:5432,10.0.0.3". They share
+# the primary's database name and credentials. Reads go to the least-loaded
+# healthy replica; a replica lagging more than DB_MAX_REPLICA_LAG seconds,
+# not streaming from the primary, or failing its health check is skipped until
+# it recovers. After a write through the API, reads stay on the primary until a
+# replica has replayed past the write (read-your-writes).
+REPLICA_HOSTS = [h.strip() for h in os.getenv("DB_REPLICA_HOSTS", "").split(",") if h.strip()]
+MAX_REPLICA_LAG = float(os.getenv("DB_MAX_REPLICA_LAG", "10"))
+HEALTH_INTERVAL = float(os.getenv("DB_HEALTH_INTERVAL", "5"))
+
+# Errors after which a replica is marked down and the query retried on the primary
+_CONNECTION_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.exceptions.PostgresConnectionError, asyncpg.exceptions.InterfaceError)
+# A hot standby cancels queries that conflict with WAL replay (vacuum cleanup,
+# locks) with 40001 or 57014; the replica is fine, the query is retried on the
+# primary. Client-side deadlines surface as asyncio.TimeoutError, not 57014.
+_RECOVERY_CONFLICTS = (asyncpg.exceptions.SerializationError, asyncpg.exceptions.QueryCanceledError)
+
+# (lane, deadline) of the current request, set by query_budget()
+_budget: ContextVar[tuple[str, Optional[float]]] = ContextVar("db_budget", default=("interactive", None))
+
+
+class DatabaseBusy(Exception):
+    """No connection could be obtained in time; surfaced as 503."""
+
+
+class QueryDeadlineExceeded(Exception):
+    """The request ran out of its query time budget; surfaced as 504."""
+
+
+def query_budget(lane: str, timeout_ms: int):
+    """Dependency that assigns the request a lane and a query deadline."""
+    async def dependency():
+        _budget.set((lane, time.monotonic() + timeout_ms / 1000))
+    return dependency
+
+
+def statement_timeout() -> Optional[float]:
+    """Seconds left in the request's query budget, for asyncpg's timeout= argument.
+
+    None outside a request (background refreshes run unbounded). Raises
+    QueryDeadlineExceeded once the budget is spent.
+    """
+    _, deadline = _budget.get()
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise QueryDeadlineExceeded()
+    return remaining
+
+
+class _Node:
+    """One Postgres server: its pool, lane semaphores and health."""
+
+    def __init__(self, name: str, host: str, port: int):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.pool = None
+        self.lanes = {lane: asyncio.Semaphore(slots) for lane, slots in LANE_SLOTS.items()}
+        self.waiting = {lane: 0 for lane in LANE_SLOTS}
+        self.active = 0
+        # replicas only take reads after their first successful health check
+        self.healthy = name == "primary"
+        self.lag = 0.0
+        self.replay_lsn = 0
+        # health checks use their own connection so a saturated pool does not
+        # look like a dead server, and a dead server is not hidden by the pool
+        self.probe = None
+
+    @property
+    def load(self) -> float:
+        return (self.active + sum(self.waiting.values())) / POOL_MAX_SIZE
+
+    def _connect_args(self) -> dict:
+        return {
+            "host": self.host,
+            "port": self.port,
+            "database": os.getenv("DB_NAME", "uniandes"),
+            "user": os.getenv("DB_USER", "nicoyapur"),
+            "password": os.getenv("DB_PASSWORD", "Yapur2025###"),
+        }
+
+    async def get_pool(self):
+        if self.pool is None:
+            self.pool = await asyncpg.create_pool(
+                **self._connect_args(),
+                min_size=2,
+                max_size=POOL_MAX_SIZE,
+            )
+        return self.pool
+
+    @asynccontextmanager
+    async def acquire(self, lane: str):
+        sem = self.lanes[lane]
+        remaining = statement_timeout()
+        wait = ACQUIRE_TIMEOUT if remaining is None else min(ACQUIRE_TIMEOUT, remaining)
+
+        if sem.locked() and self.waiting[lane] >= MAX_QUEUE:
+            raise DatabaseBusy(f"{self.name} {lane} queue full")
+        self.waiting[lane] += 1
+        try:
+            await asyncio.wait_for(sem.acquire(), wait)
+        except asyncio.TimeoutError:
+            raise DatabaseBusy(f"{self.name} {lane} lane saturated")
+        finally:
+            self.waiting[lane] -= 1
+
+        self.active += 1
+        try:
+            pool = await self.get_pool()
+            try:
+                conn = await pool.acquire(timeout=wait)
+            except asyncio.TimeoutError:
+                raise DatabaseBusy(f"{self.name} pool exhausted")
+            try:
+                yield conn
+            finally:
+                await pool.release(conn)
+        finally:
+            self.active -= 1
+            sem.release()
+
+    async def _probe_fetchrow(self, query: str, *args):
+        try:
+            if self.probe is None or self.probe.is_closed():
+                self.probe = await asyncpg.connect(**self._connect_args(), timeout=ACQUIRE_TIMEOUT)
+            return await self.probe.fetchrow(query, *args, timeout=ACQUIRE_TIMEOUT)
+        except Exception:
+            await self.close_probe()
+            raise
+
+    async def close_probe(self):
+        if self.probe is not None:
+            self.probe.terminate()
+            self.probe = None
+
+    def _check_failed(self, e: Exception):
+        if isinstance(e, _CONNECTION_ERRORS):
+            if self.healthy:
+                print(f"[DB Health] {self.name} down: {e}")
+        else:
+            # a broken health query must not pass for an outage
+            print(f"[DB Health] {self.name} check error: {type(e).__name__}: {e}")
+        self.healthy = False
+
+    async def wal_lsn(self) -> Optional[str]:
+        """Probe the primary; returns its current WAL position, or None if it cannot be read."""
+        try:
+            row = await self._probe_fetchrow("SELECT pg_current_wal_lsn()::text as lsn")
+        except Exception as e:
+            # replicas then fall back to checking their own WAL receiver
+            self._check_failed(e)
+            return None
+        if not self.healthy:
+            print(f"[DB Health] {self.name} up")
+        self.healthy = True
+        return row["lsn"]
+
+    async def check(self, primary_lsn: Optional[str]):
+        try:
+            # Caught up (zero lag) only when the replica has replayed the
+            # primary's current position; without it, only when streaming and
+            # everything received is replayed. A replica that lost its WAL
+            # receiver is never reported as caught up.
+            # the LSN is bound as text: asyncpg sends pg_lsn parameters as int8
+            row = await self._probe_fetchrow("""
+                SELECT
+                    pg_last_wal_replay_lsn()::text as replay_lsn,
+                    CASE
+                        WHEN $1::text IS NOT NULL
+                             AND pg_wal_lsn_diff($1::text::pg_lsn, pg_last_wal_replay_lsn()) <= 0 THEN 0
+                        WHEN $1::text IS NULL
+                             AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming')
+                             AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8, 'Infinity'::float8)
+                    END as lag
+            """, primary_lsn)
+            self.replay_lsn = _parse_lsn(row["replay_lsn"])
+            self.lag = float(row["lag"])
+            self.healthy = self.lag <= MAX_REPLICA_LAG
+        except Exception as e:
+            self._check_failed(e)
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "host": f"{self.host}:{self.port}",
+            "healthy": self.healthy,
+            "lag_seconds": round(self.lag, 3) if math.isfinite(self.lag) else None,
+            "active": self.active,
+            "waiting": sum(self.waiting.values()),
+        }
+
+
+def _parse_lsn(value: Optional[str]) -> int:
+    # pg_lsn text is two hex halves, e.g. "16/B374D848"
+    if not value:
+        return 0
+    hi, _, lo = value.partition("/")
+    return (int(hi, 16) << 32) | int(lo, 16)
+
+
+def _parse_host(value: str, default_port: int) -> tuple[str, int]:
+    host, _, port = value.partition(":")
+    return host, int(port) if port else default_port
+
+
+_primary = _Node("primary", os.getenv("DB_HOST", "77.37.68.210"), int(os.getenv("DB_PORT", "5432")))
+_replicas = [
+    _Node(f"replica{i}", *_parse_host(h, _primary.port))
+    for i, h in enumerate(REPLICA_HOSTS, start=1)
+]
+_health_task = None
+# Highest primary WAL position written through this process
+_write_lsn = 0
+
+
+def _pick_reader() -> _Node:
+    healthy = [n for n in _replicas if n.healthy and n.replay_lsn >= _write_lsn]
+    if not healthy:
+        return _primary
+    return min(healthy, key=lambda n: n.load)
+
 
 async def get_pool():
-    global _pool
-    if _pool is None:
-        _pool = await asyncpg.create_pool(
-            host=os.getenv("DB_HOST", "77.37.68.210"),
-            port=int(os.getenv("DB_PORT", "5432")),
-            database=os.getenv("DB_NAME", "uniandes"),
-            user=os.getenv("DB_USER", "nicoyapur"),
-            password=os.getenv("DB_PASSWORD", "Yapur2025###"),
-            min_size=2,
-            max_size=10,
-        )
-    return _pool
-
-async def fetch_all(query: str, *args):
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(query, *args)
-        return [dict(r) for r in rows]
-
-async def fetch_one(query: str, *args):
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(query, *args)
-        return dict(row) if row else None
+    return await _primary.get_pool()
+
+def acquire(lane: Optional[str] = None):
+    """Connection on the primary, for writes and read-after-write work."""
+    return _primary.acquire(lane or _budget.get()[0])
+
+async def note_write(conn):
+    """Record the primary's WAL position after a committed write on conn.
+
+    Reads are kept off replicas that have not replayed up to it, so data
+    written (and cached) right after a load is never read back stale.
+    """
+    global _write_lsn
+    if not _replicas:
+        return
+    lsn = _parse_lsn(await conn.fetchval("SELECT pg_current_wal_lsn()::text"))
+    _write_lsn = max(_write_lsn, lsn)
+
+async def _run(conn, method: str, query: str, args):
+    # asyncpg cancels the statement server-side when the timeout expires;
+    # the timeout is the deadline, not a connection failure to retry.
+    try:
+        return await getattr(conn, method)(query, *args, timeout=statement_timeout())
+    except asyncio.TimeoutError:
+        raise QueryDeadlineExceeded()
+
+async def _read(method: str, query: str, args, primary: bool):
+    node = _primary if primary else _pick_reader()
+    lane = _budget.get()[0]
+    if node is not _primary:
+        try:
+            async with node.acquire(lane) as conn:
+                return await _run(conn, method, query, args)
+        except _CONNECTION_ERRORS as e:
+            print(f"[DB] {node.name} failed, retrying on primary: {e}")
+            node.healthy = False
+        except _RECOVERY_CONFLICTS as e:
+            print(f"[DB] {node.name} cancelled the query, retrying on primary: {e}")
+    async with _primary.acquire(lane) as conn:
+        return await _run(conn, method, query, args)
+
+async def fetch_all(query: str, *args, primary: bool = False):
+    rows = await _read("fetch", query, args, primary)
+    return [dict(r) for r in rows]
+
+async def fetch_one(query: str, *args, primary: bool = False):
+    row = await _read("fetchrow", query, args, primary)
+    return dict(row) if row else None
+
+async def _health_loop():
+    while True:
+        primary_lsn = await _primary.wal_lsn()
+        await asyncio.gather(*(n.check(primary_lsn) for n in _replicas))
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+def start_health_checks():
+    # also runs without replicas, so /health/db reports the primary's probe
+    global _health_task
+    if _health_task is None:
+        _health_task = asyncio.create_task(_health_loop())
+
+def db_status() -> dict:
+    return {"primary": _primary.status(), "replicas": [n.status() for n in _replicas]}
 
 async def close_pool():
-    global _pool
-    if _pool:
-        await _pool.close()
-        _pool = None
+    global _health_task
+    if _health_task:
+        _health_task.cancel()
+        _health_task = None
+    for node in [_primary, *_replicas]:
+        await node.close_probe()
+        if node.pool:
+            await node.pool.close()
+            node.pool = None
@@ -0,0 +1,539 @@
+"""
+Incrementally maintained summary tables derived from fact_contactos.
+
+lead_journeys holds one row per lead with the milestones of its contact
+journey, so cohort and time-to-conversion charts read a compact table
+instead of re-windowing every call.
+
+agent_day_sketches / agent_sketch_totals hold HyperLogLog sketches of the
+distinct leads each agent worked, per day and all-time, for the approximate
+agent leaderboard.
+"""
+import asyncio
+import os
+from collections import defaultdict
+from database import acquire, note_write, statement_timeout
+from cache import bump_data_version
+from sketches import sketch_values, union_bytes
+
+# Subcategory categories that count as an effective contact
+# (3 = Interesado, 5 = Matriculado in dim_subcategorias).
+EFFECTIVE_CATEGORIES = ("3", "5")
+ENROLLED_SUBCATEGORY = "116"
+
+# Per-agent distinct-lead metrics, mirroring the FILTER clauses of /agents.
+AGENT_METRICS = {
+    "total_leads": lambda resultado, subcat: True,
+    "contactados": lambda resultado, subcat: resultado in ("Contactado", "Contacto Efectivo"),
+    "contacto_efectivo": lambda resultado, subcat: resultado == "Contacto Efectivo",
+    "no_contactados": lambda resultado, subcat: resultado == "No Contactado",
+    "matriculados": lambda resultado, subcat: subcat == ENROLLED_SUBCATEGORY,
+}
+
+# Refreshes that consume rollup_queue; the queue triggers queue each lead for all
+ROLLUP_CONSUMERS = ("journeys", "sketches")
+
+REFRESH_INTERVAL = int(os.getenv("ROLLUP_REFRESH_SECONDS", "300"))
+# Refreshes requested by writes within this many seconds are run as one
+REFRESH_DEBOUNCE = float(os.getenv("ROLLUP_REFRESH_DEBOUNCE_SECONDS", "2"))
+# Rows fetched per round trip while streaming the calls of the days to re-sketch
+SKETCH_FETCH_ROWS = int(os.getenv("ROLLUP_SKETCH_FETCH_ROWS", "5000"))
+
+# Statement-level triggers on the source tables queue every lead they touch
+# for all consumers, and every call day for the agent sketches, whoever writes
+# (n8n, the ingest API, manual fixes), so refreshes only look at what changed.
+# (suffix, event, transition table)
+_QUEUE_TRIGGERS = [
+    ("ins", "INSERT", "NEW"),
+    ("upd_new", "UPDATE", "NEW"),
+    ("upd_old", "UPDATE", "OLD"),
+    ("del", "DELETE", "OLD"),
+]
+# (table, trigger name prefix, trigger function)
+_QUEUED_TABLES = [
+    ("dim_contactos", "rollup", "rollup_enqueue_leads"),
+    ("fact_contactos", "rollup", "rollup_enqueue_leads"),
+    ("fact_contactos", "sketch_days", "rollup_enqueue_days"),
+]
+
+# Lookups by lead and by call time on the source tables, and by the key the
+# ingest merge replaces rows on; built concurrently so writes go on.
+_SOURCE_INDEXES = [
+    ("dim_contactos", "idinterno"),
+    ("fact_contactos", "idinterno"),
+    ("fact_contactos", "fecha"),
+    ("fact_contactos", "dedup_key"),
+]
+
+_ensured = False
+_refresh_lock = asyncio.Lock()
+_requested_task = None
+_refresh_requested = False
+
+
+def _consumers_sql() -> str:
+    return ", ".join(f"('{c}')" for c in ROLLUP_CONSUMERS)
+
+
+async def _ensure_queue_triggers(conn):
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('rollup_queue_triggers'))")
+        await conn.execute(f"""
+            CREATE OR REPLACE FUNCTION rollup_enqueue_leads() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                INSERT INTO rollup_queue (consumer, idinterno)
+                SELECT q.consumer, r.idinterno
+                FROM (SELECT DISTINCT idinterno::text as idinterno FROM changed_rows WHERE idinterno IS NOT NULL) r
+                CROSS JOIN (VALUES {_consumers_sql()}) q(consumer)
+                ON CONFLICT DO NOTHING;
+                RETURN NULL;
+            END
+            $$
+        """)
+        # Days are queued as text: a malformed fecha must not fail the write
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION rollup_enqueue_days() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                INSERT INTO sketch_day_queue (dia)
+                SELECT DISTINCT left(fecha::text, 10) FROM changed_rows
+                WHERE NULLIF(fecha::text, '') IS NOT NULL
+                ON CONFLICT DO NOTHING;
+                RETURN NULL;
+            END
+            $$
+        """)
+        tables = {t for t, _, _ in _QUEUED_TABLES}
+        existing = {
+            r["tgname"] for r in await conn.fetch(f"""
+                SELECT tgname FROM pg_trigger
+                WHERE NOT tgisinternal
+                  AND tgrelid IN ({", ".join(f"'{t}'::regclass" for t in tables)})
+            """)
+        }
+        for table, prefix, function in _QUEUED_TABLES:
+            for suffix, event, rows in _QUEUE_TRIGGERS:
+                name = f"{table}_{prefix}_{suffix}"
+                if name not in existing:
+                    await conn.execute(f"""
+                        CREATE TRIGGER {name} AFTER {event} ON {table}
+                        REFERENCING {rows} TABLE AS changed_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION {function}()
+                    """)
+        if "dim_contactos_rollup_ins" not in existing:
+            # leads written before the triggers existed; the first refresh builds them
+            await conn.execute(f"""
+                INSERT INTO rollup_queue (consumer, idinterno)
+                SELECT q.consumer, c.idinterno
+                FROM (SELECT DISTINCT idinterno::text as idinterno FROM dim_contactos WHERE idinterno IS NOT NULL) c
+                CROSS JOIN (VALUES {_consumers_sql()}) q(consumer)
+                ON CONFLICT DO NOTHING
+            """)
+        if "fact_contactos_sketch_days_ins" not in existing:
+            await conn.execute("""
+                INSERT INTO sketch_day_queue (dia)
+                SELECT DISTINCT left(fecha::text, 10) FROM fact_contactos
+                WHERE NULLIF(fecha::text, '') IS NOT NULL
+                ON CONFLICT DO NOTHING
+            """)
+
+
+async def ensure_rollup_tables():
+    global _ensured
+    if _ensured:
+        return
+    async with acquire("heavy") as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS lead_journeys (
+                idinterno TEXT PRIMARY KEY,
+                base TEXT,
+                fecha_lead DATE,
+                cohort_week DATE,
+                touches INTEGER NOT NULL DEFAULT 0,
+                first_touch_at TIMESTAMP,
+                last_touch_at TIMESTAMP,
+                first_effective_at TIMESTAMP,
+                touches_to_effective INTEGER,
+                enrolled_at TIMESTAMP,
+                touches_to_enrollment INTEGER,
+                updated_at TIMESTAMP NOT NULL DEFAULT now()
+            );
+            CREATE INDEX IF NOT EXISTS lead_journeys_cohort_idx ON lead_journeys (cohort_week);
+            CREATE INDEX IF NOT EXISTS lead_journeys_base_cohort_idx ON lead_journeys (base, cohort_week);
+            CREATE INDEX IF NOT EXISTS lead_journeys_last_touch_idx ON lead_journeys (last_touch_at);
+
+            CREATE TABLE IF NOT EXISTS rollup_queue (
+                consumer TEXT NOT NULL,
+                idinterno TEXT NOT NULL,
+                PRIMARY KEY (consumer, idinterno)
+            );
+
+            CREATE TABLE IF NOT EXISTS agent_day_sketches (
+                dia DATE NOT NULL,
+                iddatabase TEXT NOT NULL,
+                usuario TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                sketch BYTEA NOT NULL,
+                PRIMARY KEY (dia, iddatabase, usuario, metric)
+            );
+            CREATE INDEX IF NOT EXISTS agent_day_sketches_agent_idx ON agent_day_sketches (iddatabase, usuario);
+            CREATE TABLE IF NOT EXISTS agent_sketch_totals (
+                iddatabase TEXT NOT NULL,
+                usuario TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                sketch BYTEA NOT NULL,
+                PRIMARY KEY (iddatabase, usuario, metric)
+            );
+            -- call days (fact_contactos.fecha prefix) whose sketches must be rebuilt
+            CREATE TABLE IF NOT EXISTS sketch_day_queue (
+                dia TEXT PRIMARY KEY
+            );
+        """)
+        for table, column in _SOURCE_INDEXES:
+            # CONCURRENTLY cannot run inside a transaction, so one statement each
+            await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_{column}_idx ON {table} ({column})")
+        await _ensure_queue_triggers(conn)
+        await note_write(conn)
+    _ensured = True
+
+
+async def refresh_journeys(full: bool = False) -> int:
+    """Recompute journeys for the leads queued in rollup_queue.
+
+    The queue triggers add every lead whose dim or fact rows were written, so
+    the cost follows the changes, not the table sizes, through the idinterno
+    indexes. Each queued lead's whole call history is re-windowed so touch
+    numbers stay correct; leads gone from dim_contactos are removed.
+    full=True recomputes every lead. Returns the number of rows that changed.
+    """
+    await ensure_rollup_tables()
+    effective = ", ".join(f"'{c}'" for c in EFFECTIVE_CATEGORIES)
+
+    if full:
+        changed = """
+            SELECT idinterno FROM queued
+            UNION
+            SELECT idinterno::text FROM dim_contactos
+            UNION
+            SELECT idinterno FROM lead_journeys
+        """
+    else:
+        changed = "SELECT idinterno FROM queued"
+
+    query = f"""
+        WITH queued AS (
+            DELETE FROM rollup_queue WHERE consumer = 'journeys' RETURNING idinterno
+        ),
+        changed AS ({changed}),
+        leads AS (
+            -- dim_contactos has no unique key; keep the latest row per lead
+            SELECT DISTINCT ON (c.idinterno::text)
+                c.idinterno::text as idinterno, c.base, c.fecha_a_utilizar
+            FROM dim_contactos c
+            JOIN changed ch ON ch.idinterno = c.idinterno::text
+            ORDER BY c.idinterno::text, c.ctid DESC
+        ),
+        touches AS (
+            SELECT
+                f.idinterno::text as idinterno,
+                NULLIF(f.fecha::text, '')::timestamp as ts,
+                ROW_NUMBER() OVER (
+                    PARTITION BY f.idinterno
+                    ORDER BY NULLIF(f.fecha::text, '')::timestamp, f.dedup_key
+                ) as n,
+                COALESCE(s.categoria::text IN ({effective}), FALSE) as efectivo,
+                (f.subcategoria::text = '{ENROLLED_SUBCATEGORY}'
+                    OR COALESCE(NULLIF(f.idventa::text, ''), '0') != '0') as matricula
+            FROM fact_contactos f
+            JOIN changed ch ON ch.idinterno = f.idinterno::text
+            LEFT JOIN dim_subcategorias s ON s.subcategoria::text = f.subcategoria::text
+            WHERE NULLIF(f.fecha::text, '') IS NOT NULL
+        ),
+        journeys AS (
+            SELECT
+                idinterno,
+                COUNT(*) as touches,
+                MIN(ts) as first_touch_at,
+                MAX(ts) as last_touch_at,
+                MIN(ts) FILTER (WHERE efectivo) as first_effective_at,
+                MIN(n) FILTER (WHERE efectivo) as touches_to_effective,
+                MIN(ts) FILTER (WHERE matricula) as enrolled_at,
+                MIN(n) FILTER (WHERE matricula) as touches_to_enrollment
+            FROM touches
+            GROUP BY idinterno
+        ),
+        removed AS (
+            DELETE FROM lead_journeys lj
+            USING changed ch
+            WHERE lj.idinterno = ch.idinterno
+              AND NOT EXISTS (SELECT 1 FROM leads l WHERE l.idinterno = ch.idinterno)
+            RETURNING 1
+        ),
+        upserted AS (
+            INSERT INTO lead_journeys (
+                idinterno, base, fecha_lead, cohort_week, touches, first_touch_at, last_touch_at,
+                first_effective_at, touches_to_effective, enrolled_at, touches_to_enrollment, updated_at
+            )
+            SELECT
+                c.idinterno,
+                c.base,
+                CAST(NULLIF(c.fecha_a_utilizar::text, '') AS DATE),
+                CAST(DATE_TRUNC('week', CAST(NULLIF(c.fecha_a_utilizar::text, '') AS DATE)) AS DATE),
+                COALESCE(j.touches, 0),
+                j.first_touch_at,
+                j.last_touch_at,
+                j.first_effective_at,
+                j.touches_to_effective,
+                j.enrolled_at,
+                j.touches_to_enrollment,
+                now()
+            FROM leads c
+            LEFT JOIN journeys j ON j.idinterno = c.idinterno
+            ON CONFLICT (idinterno) DO UPDATE SET
+                base = EXCLUDED.base,
+                fecha_lead = EXCLUDED.fecha_lead,
+                cohort_week = EXCLUDED.cohort_week,
+                touches = EXCLUDED.touches,
+                first_touch_at = EXCLUDED.first_touch_at,
+                last_touch_at = EXCLUDED.last_touch_at,
+                first_effective_at = EXCLUDED.first_effective_at,
+                touches_to_effective = EXCLUDED.touches_to_effective,
+                enrolled_at = EXCLUDED.enrolled_at,
+                touches_to_enrollment = EXCLUDED.touches_to_enrollment,
+                updated_at = EXCLUDED.updated_at
+            WHERE (
+                lead_journeys.base, lead_journeys.fecha_lead, lead_journeys.touches,
+                lead_journeys.first_touch_at, lead_journeys.last_touch_at,
+                lead_journeys.first_effective_at, lead_journeys.enrolled_at,
+                lead_journeys.touches_to_effective, lead_journeys.touches_to_enrollment
+            ) IS DISTINCT FROM (
+                EXCLUDED.base, EXCLUDED.fecha_lead, EXCLUDED.touches,
+                EXCLUDED.first_touch_at, EXCLUDED.last_touch_at,
+                EXCLUDED.first_effective_at, EXCLUDED.enrolled_at,
+                EXCLUDED.touches_to_effective, EXCLUDED.touches_to_enrollment
+            )
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM removed) + (SELECT COUNT(*) FROM upserted)
+    """
+
+    async with _refresh_lock:
+        async with acquire("heavy") as conn:
+            changed_rows = await conn.fetchval(query, timeout=statement_timeout())
+            if changed_rows:
+                await note_write(conn)
+
+    if changed_rows:
+        bump_data_version()
+    return changed_rows
+
+
+def _sketch_day(rows) -> dict:
+    values = defaultdict(set)
+    for r in rows:
+        for metric, matches in AGENT_METRICS.items():
+            if matches(r["resultado_gestion"], r["ultima_subcategoria"]):
+                values[(r["iddatabase"], r["usuario"], metric)].add(r["idinterno"])
+    return {key: sketch_values(v) for key, v in values.items()}
+
+
+def _union_by_metric(rows) -> dict:
+    blobs = defaultdict(list)
+    for r in rows:
+        blobs[r["metric"]].append(r["sketch"])
+    return {metric: union_bytes(b) for metric, b in blobs.items()}
+
+
+async def refresh_agent_sketches(full: bool = False) -> int:
+    """Rebuild the agent day sketches that may have changed, then their totals.
+
+    A day is rebuilt from scratch when the queue triggers recorded a call
+    written on it, or when it has calls from a lead queued because its dim
+    row changed. Rebuilding whole days is what lets a lead move between
+    metrics, which a union-only update cannot do. Totals are then re-unioned
+    from the day sketches of the affected agents.
+
+    The calls of all those days are streamed in one pass ordered by day
+    (through the fecha index), hashing runs in a worker thread, and memory
+    is bounded by one day of calls. If the rebuild fails, its days are
+    queued again. full=True rebuilds every day. Returns the number of day
+    sketches that changed.
+    """
+    await ensure_rollup_tables()
+    every_day = """
+        UNION
+        SELECT left(fecha::text, 10) FROM fact_contactos WHERE NULLIF(fecha::text, '') IS NOT NULL
+        UNION
+        SELECT dia::text FROM agent_day_sketches
+    """ if full else ""
+    written = 0
+    affected = set()
+
+    async def rebuild(conn, dia, rows):
+        nonlocal written
+        new = await asyncio.to_thread(_sketch_day, rows)
+        old = {
+            (r["iddatabase"], r["usuario"], r["metric"]): bytes(r["sketch"])
+            for r in await conn.fetch(
+                "SELECT iddatabase, usuario, metric, sketch FROM agent_day_sketches WHERE dia = $1", dia,
+                timeout=statement_timeout(),
+            )
+        }
+        if new == old:
+            return
+        await conn.execute("DELETE FROM agent_day_sketches WHERE dia = $1", dia, timeout=statement_timeout())
+        if new:
+            await conn.copy_records_to_table(
+                "agent_day_sketches",
+                records=[(dia, *key, sketch) for key, sketch in new.items()],
+                columns=["dia", "iddatabase", "usuario", "metric", "sketch"],
+                timeout=statement_timeout(),
+            )
+        affected.update((k[0], k[1]) for k in new.keys() | old.keys())
+        written += 1
+
+    async with _refresh_lock:
+        async with acquire("heavy") as conn:
+            # The queues are drained in a short transaction of their own, so
+            # writers queueing the same leads do not wait for the rebuild.
+            # sketch_days may be left over from a failed run on this connection.
+            await conn.execute("DROP TABLE IF EXISTS sketch_days; CREATE TEMP TABLE sketch_days (dia DATE PRIMARY KEY)")
+            async with conn.transaction():
+                await conn.execute(f"""
+                    WITH leads AS (
+                        DELETE FROM rollup_queue WHERE consumer = 'sketches' RETURNING idinterno
+                    ),
+                    queued AS (
+                        DELETE FROM sketch_day_queue RETURNING dia
+                    )
+                    INSERT INTO sketch_days (dia)
+                    SELECT dia::date FROM (
+                        SELECT dia FROM queued
+                        UNION
+                        SELECT left(f.fecha::text, 10)
+                        FROM fact_contactos f
+                        JOIN leads l ON l.idinterno = f.idinterno::text
+                        WHERE NULLIF(f.fecha::text, '') IS NOT NULL
+                        {every_day}
+                    ) d
+                    WHERE dia ~ '^[0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}}$'
+                """, timeout=statement_timeout())
+            await conn.execute("ANALYZE sketch_days")
+            days = [r["dia"] for r in await conn.fetch("SELECT dia FROM sketch_days ORDER BY dia")]
+            try:
+                async with conn.transaction():
+                    # fecha is compared as text so each day is an index range scan
+                    calls = conn.cursor("""
+                        SELECT
+                            d.dia,
+                            COALESCE(f.iddatabase::text, '') as iddatabase,
+                            f.usuario,
+                            f.idinterno::text as idinterno,
+                            c.resultado_gestion,
+                            c.ultima_subcategoria::text as ultima_subcategoria
+                        FROM sketch_days d
+                        JOIN fact_contactos f
+                          ON f.fecha::text >= to_char(d.dia, 'YYYY-MM-DD')
+                         AND f.fecha::text < to_char(d.dia + 1, 'YYYY-MM-DD')
+                        JOIN dim_contactos c ON f.idinterno = c.idinterno
+                        WHERE f.usuario IS NOT NULL AND f.usuario != ''
+                        ORDER BY d.dia
+                    """, prefetch=SKETCH_FETCH_ROWS, timeout=statement_timeout())
+                    seen = set()
+                    dia, rows = None, []
+                    async for r in calls:
+                        if r["dia"] != dia:
+                            if dia is not None:
+                                await rebuild(conn, dia, rows)
+                            dia, rows = r["dia"], []
+                            seen.add(dia)
+                        rows.append(r)
+                    if dia is not None:
+                        await rebuild(conn, dia, rows)
+                    del rows
+                    # days left without calls lose their sketches
+                    for dia in days:
+                        if dia not in seen:
+                            await rebuild(conn, dia, [])
+
+                    if full:
+                        for r in await conn.fetch("""
+                            SELECT iddatabase, usuario FROM agent_sketch_totals
+                            UNION SELECT iddatabase, usuario FROM agent_day_sketches
+                        """, timeout=statement_timeout()):
+                            affected.add((r["iddatabase"], r["usuario"]))
+
+                    for iddatabase, usuario in affected:
+                        rows = await conn.fetch("""
+                            SELECT metric, sketch FROM agent_day_sketches
+                            WHERE iddatabase = $1 AND usuario = $2
+                        """, iddatabase, usuario, timeout=statement_timeout())
+                        merged = await asyncio.to_thread(_union_by_metric, rows)
+                        await conn.execute(
+                            "DELETE FROM agent_sketch_totals WHERE iddatabase = $1 AND usuario = $2", iddatabase, usuario,
+                            timeout=statement_timeout(),
+                        )
+                        if merged:
+                            await conn.executemany("""
+                                INSERT INTO agent_sketch_totals (iddatabase, usuario, metric, sketch)
+                                VALUES ($1, $2, $3, $4)
+                            """, [(iddatabase, usuario, metric, sketch) for metric, sketch in merged.items()], timeout=statement_timeout())
+            except BaseException:
+                try:
+                    await conn.execute("""
+                        INSERT INTO sketch_day_queue (dia)
+                        SELECT to_char(d, 'YYYY-MM-DD') FROM unnest($1::date[]) d
+                        ON CONFLICT DO NOTHING
+                    """, days)
+                except Exception as e:
+                    print(f"[Rollup Refresh Error] could not queue {len(days)} sketch days again: {e}")
+                raise
+            await conn.execute("DROP TABLE sketch_days")
+            if written:
+                await note_write(conn)
+
+    if written:
+        bump_data_version()
+    return written
+
+
+async def refresh_all(full: bool = False) -> dict:
+    return {
+        "upserted": await refresh_journeys(full=full),
+        "sketches": await refresh_agent_sketches(full=full),
+    }
+
+
+def request_refresh():
+    """Schedule a refresh_all soon, coalescing requests made meanwhile.
+
+    At most one refresh is pending at any time: requests made while it waits
+    are absorbed, requests made while it runs schedule exactly one more.
+    """
+    global _requested_task, _refresh_requested
+    _refresh_requested = True
+    if _requested_task is None or _requested_task.done():
+        _requested_task = asyncio.create_task(_run_requested_refreshes())
+
+
+async def _run_requested_refreshes():
+    global _refresh_requested
+    while _refresh_requested:
+        await asyncio.sleep(REFRESH_DEBOUNCE)
+        _refresh_requested = False
+        try:
+            await refresh_all()
+        except Exception as e:
+            print(f"[Rollup Refresh Error] {e}")
+
+
+async def refresh_loop():
+    if REFRESH_INTERVAL <= 0:
+        return
+    while True:
+        try:
+            await refresh_all()
+        except Exception as e:
+            print(f"[Rollup Refresh Error] {e}")
+        await asyncio.sleep(REFRESH_INTERVAL)
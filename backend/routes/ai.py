@@ -1,5 +1,7 @@
 import os
 import json
+import time
+import hashlib
 import httpx
 import asyncio
 from fastapi import APIRouter, Depends
@@ -14,6 +16,73 @@ router = APIRouter(prefix="/api/ai", tags=["ai"])
 
 MODEL = "llama-3.3-70b-versatile"
 GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT_SECONDS", "12"))
+
+
+class LLMUnavailable(Exception):
+    pass
+
+
+class _CircuitBreaker:
+    """Stops calling the LLM after repeated failures.
+
+    After `threshold` consecutive failures the breaker opens for `cooldown`
+    seconds; then a single trial call is let through (half-open) and its
+    outcome closes or re-opens it.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.cooldown or self.trial_running:
+            return False
+        self.trial_running = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        # A trial cancelled before its outcome is known must not keep the
+        # breaker half-open forever; the next call becomes the trial.
+        self.trial_running = False
+
+
+_breaker = _CircuitBreaker(
+    threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", "3")),
+    cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "60")),
+)
+
+# Last good answers, served while the LLM is failing or the breaker is open.
+_answers = {}
+_ANSWERS_MAX = 256
+
+
+def _answer_key(kind: str, *parts) -> str:
+    raw = json.dumps(parts, default=str, ensure_ascii=False, sort_keys=True)
+    return f"{kind}:{hashlib.sha1(raw.encode('utf-8')).hexdigest()}"
+
+
+def _remember(key: str, value):
+    if len(_answers) >= _ANSWERS_MAX:
+        _answers.pop(next(iter(_answers)))
+    _answers[key] = value
+    return value
 
 
 async def _groq_chat_async(messages: list, temperature: float = 0.3, max_tokens: int = 800) -> str:
@@ -21,7 +90,21 @@ async def _groq_chat_async(messages: list, temperature: float = 0.3, max_tokens:
     api_key = os.getenv("GROQ_API_KEY")
     if not api_key:
         raise Exception("GROQ_API_KEY no configurada en el servidor")
+    if not _breaker.allow():
+        raise LLMUnavailable("Servicio de IA no disponible temporalmente")
+
+    try:
+        content = await _groq_post(api_key, messages, temperature, max_tokens)
+    except Exception:
+        _breaker.record_failure()
+        raise
+    finally:
+        _breaker.release_trial()
+    _breaker.record_success()
+    return content
 
+
+async def _groq_post(api_key: str, messages: list, temperature: float, max_tokens: int) -> str:
     async with httpx.AsyncClient() as client:
         resp = await client.post(
             GROQ_URL,
@@ -35,13 +118,50 @@ async def _groq_chat_async(messages: list, temperature: float = 0.3, max_tokens:
                 "temperature": temperature,
                 "max_tokens": max_tokens,
             },
-            timeout=30.0,
+            timeout=LLM_TIMEOUT,
         )
         resp.raise_for_status()
         data = resp.json()
         return data["choices"][0]["message"]["content"]
 
 
+def _fallback_insights(context_data: dict) -> list:
+    """Rule-based insights from the dashboard context, used when the LLM is down."""
+    kpis = context_data.get("kpis") or {}
+    total = kpis.get("total_leads") or 0
+    if not total:
+        return [{"icon": "alert", "title": "IA no disponible", "description": "El análisis automático no está disponible en este momento."}]
+
+    contactados = kpis.get("contactados") or 0
+    efectivos = kpis.get("contacto_efectivo") or 0
+    matriculados = kpis.get("matriculados") or 0
+    insights = [
+        {"icon": "trending_up", "title": "Tasa de contacto", "description": f"{contactados / total * 100:.1f}% de los {total} leads fue contactado."},
+        {"icon": "star", "title": "Contacto efectivo", "description": f"{efectivos / total * 100:.1f}% de los leads tuvo contacto efectivo."},
+        {"icon": "trending_up", "title": "Conversión", "description": f"{matriculados} matriculados ({matriculados / total * 100:.1f}% del total)."},
+    ]
+    medios = context_data.get("byMedio") or []
+    if medios:
+        top = max(medios, key=lambda m: m.get("total") or 0)
+        insights.append({"icon": "star", "title": "Medio principal", "description": f"{top.get('medio')} aporta {top.get('total')} leads."})
+    else:
+        insights.append({"icon": "alert", "title": "Sin gestión", "description": f"{kpis.get('no_contactados') or 0} leads siguen sin contactar."})
+    return insights
+
+
+def _fallback_predictions(context_data: dict) -> list:
+    """Moving-average forecast over the last trend periods, used when the LLM is down."""
+    trends = [t for t in (context_data.get("trends") or []) if isinstance(t, dict)][-4:]
+    if not trends:
+        return []
+    avg_leads = sum(t.get("leads") or 0 for t in trends) / len(trends)
+    avg_efectivos = sum(t.get("efectivos") or 0 for t in trends) / len(trends)
+    return [
+        {"period": f"Semana {i}", "predicted_leads": round(avg_leads), "predicted_efectivos": round(avg_efectivos), "confidence": 0.5}
+        for i in range(1, 5)
+    ]
+
+
 class ChatRequest(BaseModel):
     message: str
     history: Optional[list] = []
@@ -54,6 +174,7 @@ class ContextRequest(BaseModel):
 
 @router.post("/chat")
 async def ai_chat(body: ChatRequest, _user: str = Depends(require_auth)):
+    key = _answer_key("chat", body.message, body.history, body.context_data)
     try:
         context = json.dumps(body.context_data, default=str, ensure_ascii=False) if body.context_data else "{}"
 
@@ -75,14 +196,18 @@ async def ai_chat(body: ChatRequest, _user: str = Depends(require_auth)):
         messages.append({"role": "user", "content": body.message})
 
         content = await _groq_chat_async(messages, temperature=0.3, max_tokens=800)
-        return {"response": content}
+        return {"response": _remember(key, content)}
     except Exception as e:
         print(f"[AI Chat Error] {e}")
+        if isinstance(e, (LLMUnavailable, httpx.HTTPError)):
+            return {"response": _answers.get(key) or str(e)[:200] or "Servicio de IA no disponible", "fallback": True}
         return {"response": f"Error: {str(e)[:200]}"}
 
 
 @router.post("/insights")
 async def ai_insights(body: Optional[ContextRequest] = None, _user: str = Depends(require_auth)):
+    context_data = body.context_data if body and body.context_data else {}
+    key = _answer_key("insights", context_data)
     try:
         context = json.dumps(body.context_data, default=str, ensure_ascii=False) if body and body.context_data else "{}"
 
@@ -105,18 +230,22 @@ async def ai_insights(body: Optional[ContextRequest] = None, _user: str = Depend
                 raw = raw.split("```")[1]
                 if raw.startswith("json"):
                     raw = raw[4:]
-            insights = json.loads(raw)
+            insights = _remember(key, json.loads(raw))
         except (json.JSONDecodeError, IndexError):
             insights = [{"icon": "alert", "title": "Respuesta", "description": raw[:200]}]
 
         return {"insights": insights}
     except Exception as e:
         print(f"[AI Insights Error] {e}")
+        if isinstance(e, (LLMUnavailable, httpx.HTTPError)):
+            return {"insights": _answers.get(key) or _fallback_insights(context_data), "fallback": True}
         return {"insights": [{"icon": "alert", "title": "Error", "description": str(e)[:200]}]}
 
 
 @router.post("/predictions")
 async def ai_predictions(body: Optional[ContextRequest] = None, _user: str = Depends(require_auth)):
+    context_data = body.context_data if body and body.context_data else {}
+    key = _answer_key("predictions", context_data)
     try:
         context = json.dumps(body.context_data, default=str, ensure_ascii=False) if body and body.context_data else "{}"
 
@@ -143,8 +272,12 @@ async def ai_predictions(body: Optional[ContextRequest] = None, _user: str = Dep
         except (json.JSONDecodeError, IndexError):
             predictions = []
 
+        if predictions:
+            _remember(key, predictions)
         return {"predictions": predictions}
     except Exception as e:
         print(f"[AI Predictions Error] {e}")
+        if isinstance(e, (LLMUnavailable, httpx.HTTPError)):
+            return {"predictions": _answers.get(key) or _fallback_predictions(context_data), "fallback": True}
         return {"predictions": []}
 
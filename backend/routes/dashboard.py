@@ -1,11 +1,29 @@
+import os
+import math
+import asyncio
 from fastapi import APIRouter, Depends, Query
 from typing import Optional
 from routes.auth import require_auth
-from database import fetch_all, fetch_one
-from datetime import datetime
+from database import fetch_all, fetch_one, query_budget, INTERACTIVE_TIMEOUT_MS, HEAVY_TIMEOUT_MS
+from cache import cache_get, cache_set, data_version
+from sketches import HyperLogLog, union_bytes
+from rollups import AGENT_METRICS, ensure_rollup_tables
+from datetime import datetime, date
 from collections import Counter, defaultdict
 
-router = APIRouter(prefix="/api/dashboard", tags=["dashboard"])
+# Queries run in the interactive lane unless the route opts into the heavy one.
+router = APIRouter(
+    prefix="/api/dashboard",
+    tags=["dashboard"],
+    dependencies=[Depends(query_budget("interactive", INTERACTIVE_TIMEOUT_MS))],
+)
+
+# approx=true reads a block (SYSTEM) sample of dim_contactos, so only about
+# APPROX_SAMPLE_PERCENT of its pages are read, and scales the counts up.
+# Rows of a page are correlated, so the error bounds (95% confidence) come
+# from the spread of the per-page counts, not from the row count alone.
+APPROX_SAMPLE_PERCENT = float(os.getenv("APPROX_SAMPLE_PERCENT", "5"))
+APPROX_Z = 1.96
 
 async def _get_base_filter(base: Optional[str]) -> tuple[str, list]:
     where = "WHERE 1=1"
@@ -16,29 +34,60 @@ async def _get_base_filter(base: Optional[str]) -> tuple[str, list]:
     return where, args
 
 
-@router.get("/kpis")
-async def get_kpis(
-    base: Optional[str] = Query(None),
-    _user: str = Depends(require_auth),
-):
-    where, args = await _get_base_filter(base)
-    
-    query = f"""
-        SELECT 
-            COUNT(*) as total_leads,
-            COUNT(*) FILTER (WHERE resultado_gestion IN ('Contactado', 'Contacto Efectivo')) as contactados,
-            COUNT(*) FILTER (WHERE resultado_gestion = 'No Contactado') as no_contactados,
-            COUNT(*) FILTER (WHERE resultado_gestion = 'Contacto Efectivo') as contacto_efectivo,
-            COUNT(*) FILTER (WHERE ultima_subcategoria = '116') as matriculados,
-            AVG(NULLIF(CAST(toques AS INTEGER), 0)) as avg_toques
-        FROM dim_contactos
-        {where}
+def _sampled_query(columns: str, keys: list, where: str, group: Optional[tuple] = None, extra: str = "") -> str:
+    """Counts per sampled page of dim_contactos, summed with their squares.
+
+    columns computes keys for each page; group is an optional (column, alias)
+    breakdown. The sums of squares and page_rows feed _scale_sample.
     """
-    
-    row = await fetch_one(query, *args)
+    inner_group = f"{group[0]} as {group[1]}, " if group else ""
+    outer_group = f"{group[1]}, " if group else ""
+    sums = ", ".join(f"SUM({k}) as {k}, SUM({k}::float8 * {k}) as {k}_sq" for k in keys)
+    return f"""
+        SELECT {outer_group}{sums}, MAX(page_rows) as page_rows{extra}
+        FROM (
+            SELECT {inner_group}{columns}, COUNT(*) as page_rows
+            FROM dim_contactos TABLESAMPLE SYSTEM ({APPROX_SAMPLE_PERCENT}) REPEATABLE (42)
+            {where}
+            GROUP BY {"1, " if group else ""}(ctid::text::point)[0]
+        ) pages
+        {f"GROUP BY {group[1]}" if group else ""}
+    """
+
+
+def _scale_sample(row: dict, keys: list) -> dict:
+    """Scale sampled counts in row up to the full table; returns their error bounds.
+
+    Each page is sampled with probability f, so the variance of sum / f is
+    (1 - f) / f^2 times the sum of the squared per-page counts.
+    """
+    fraction = APPROX_SAMPLE_PERCENT / 100
+    page_rows = row.pop("page_rows", None) or 1
+    errors = {}
+    for key in keys:
+        k = int(row.get(key) or 0)
+        squares = float(row.pop(f"{key}_sq", None) or 0)
+        row[key] = round(k / fraction)
+        if k == 0:
+            # no sampled page had a match: at 95% confidence at most ~3/fraction
+            # pages do (rule of three), each with up to page_rows matches
+            errors[key] = math.ceil(3 / fraction * page_rows)
+        else:
+            errors[key] = round(APPROX_Z * math.sqrt((1 - fraction) * squares) / fraction)
+    return errors
+
+
+def _sample_meta(errors: Optional[dict] = None) -> dict:
+    meta = {"method": "tablesample_system", "sample_percent": APPROX_SAMPLE_PERCENT, "confidence": 0.95}
+    if errors is not None:
+        meta["errors"] = errors
+    return meta
+
+
+def _kpis_from_row(row: Optional[dict]) -> dict:
     if not row:
         return {"total_leads": 0, "contactados": 0, "no_contactados": 0, "contacto_efectivo": 0, "matriculados": 0, "avg_toques": 0}
-        
+
     return {
         "total_leads": row["total_leads"] or 0,
         "contactados": row["contactados"] or 0,
@@ -49,31 +98,83 @@ async def get_kpis(
     }
 
 
+def _funnel_stages(total, contactados, efectivo, matriculados) -> list:
+    return [
+        {"stage": "Leads", "value": total or 0, "color": "#3b82f6"},
+        {"stage": "Contactados", "value": contactados or 0, "color": "#60a5fa"},
+        {"stage": "Contacto Efectivo", "value": efectivo or 0, "color": "#22c55e"},
+        {"stage": "Matriculados", "value": matriculados or 0, "color": "#a855f7"},
+    ]
+
+
+@router.get("/kpis")
+async def get_kpis(
+    base: Optional[str] = Query(None),
+    approx: bool = Query(False),
+    _user: str = Depends(require_auth),
+):
+    where, args = await _get_base_filter(base)
+    counts = """
+            COUNT(*) as total_leads,
+            COUNT(*) FILTER (WHERE resultado_gestion IN ('Contactado', 'Contacto Efectivo')) as contactados,
+            COUNT(*) FILTER (WHERE resultado_gestion = 'No Contactado') as no_contactados,
+            COUNT(*) FILTER (WHERE resultado_gestion = 'Contacto Efectivo') as contacto_efectivo,
+            COUNT(*) FILTER (WHERE ultima_subcategoria = '116') as matriculados"""
+    keys = ["total_leads", "contactados", "no_contactados", "contacto_efectivo", "matriculados"]
+
+    if not approx:
+        query = f"""
+            SELECT {counts},
+                AVG(NULLIF(CAST(toques AS INTEGER), 0)) as avg_toques
+            FROM dim_contactos
+            {where}
+        """
+        return _kpis_from_row(await fetch_one(query, *args))
+
+    query = _sampled_query(
+        f"""{counts},
+            SUM(NULLIF(CAST(toques AS INTEGER), 0)) as toques_sum,
+            COUNT(NULLIF(CAST(toques AS INTEGER), 0)) as toques_n""",
+        keys, where,
+        extra=", SUM(toques_sum)::float8 / NULLIF(SUM(toques_n), 0) as avg_toques",
+    )
+    row = await fetch_one(query, *args)
+    errors = _scale_sample(row or {}, keys)
+    result = _kpis_from_row(row)
+    result["approx"] = _sample_meta(errors)
+    return result
+
+
 @router.get("/funnel")
 async def get_funnel(
     base: Optional[str] = Query(None),
+    approx: bool = Query(False),
     _user: str = Depends(require_auth),
 ):
     where, args = await _get_base_filter(base)
-    
-    query = f"""
-        SELECT 
+    counts = """
             COUNT(*) as total,
             COUNT(*) FILTER (WHERE resultado_gestion IN ('Contactado', 'Contacto Efectivo')) as contactados,
             COUNT(*) FILTER (WHERE resultado_gestion = 'Contacto Efectivo') as efectivo,
-            COUNT(*) FILTER (WHERE ultima_subcategoria = '116') as matriculados
-        FROM dim_contactos
-        {where}
-    """
+            COUNT(*) FILTER (WHERE ultima_subcategoria = '116') as matriculados"""
+    keys = ["total", "contactados", "efectivo", "matriculados"]
+    if approx:
+        query = _sampled_query(counts, keys, where)
+    else:
+        query = f"""
+            SELECT {counts}
+            FROM dim_contactos
+            {where}
+        """
     row = await fetch_one(query, *args)
     row = row or {"total": 0, "contactados": 0, "efectivo": 0, "matriculados": 0}
+    errors = _scale_sample(row, keys) if approx else None
     
-    return [
-        {"stage": "Leads", "value": row["total"] or 0, "color": "#3b82f6"},
-        {"stage": "Contactados", "value": row["contactados"] or 0, "color": "#60a5fa"},
-        {"stage": "Contacto Efectivo", "value": row["efectivo"] or 0, "color": "#22c55e"},
-        {"stage": "Matriculados", "value": row["matriculados"] or 0, "color": "#a855f7"},
-    ]
+    stages = _funnel_stages(row["total"], row["contactados"], row["efectivo"], row["matriculados"])
+    if approx:
+        for stage, key in zip(stages, keys):
+            stage["error"] = errors[key]
+    return stages
 
 
 @router.get("/trends")
@@ -110,21 +211,31 @@ async def get_trends(
 @router.get("/by-medio")
 async def get_by_medio(
     base: Optional[str] = Query(None),
+    approx: bool = Query(False),
     _user: str = Depends(require_auth),
 ):
     where, args = await _get_base_filter(base)
-    
-    query = f"""
-        SELECT 
-            medio,
+    counts = """
             COUNT(*) as total,
-            COUNT(*) FILTER (WHERE resultado_gestion = 'Contacto Efectivo') as efectivos
-        FROM dim_contactos
-        {where} AND medio IS NOT NULL
-        GROUP BY medio
-        ORDER BY total DESC
-    """
+            COUNT(*) FILTER (WHERE resultado_gestion = 'Contacto Efectivo') as efectivos"""
+    where += " AND medio IS NOT NULL"
+
+    if approx:
+        query = _sampled_query(counts, ["total", "efectivos"], where, group=("medio", "medio"))
+    else:
+        query = f"""
+            SELECT
+                medio,
+                {counts}
+            FROM dim_contactos
+            {where}
+            GROUP BY medio
+        """
+    query += " ORDER BY total DESC"
     rows = await fetch_all(query, *args)
+    if approx:
+        for r in rows:
+            r["approx"] = _sample_meta(_scale_sample(r, ["total", "efectivos"]))
     return rows
 
 
@@ -132,6 +243,7 @@ async def get_by_medio(
 async def get_by_programa(
     base: Optional[str] = Query(None),
     limit: int = Query(15),
+    approx: bool = Query(False),
     _user: str = Depends(require_auth),
 ):
     where, args = await _get_base_filter(base)
@@ -140,26 +252,92 @@ async def get_by_programa(
     else:
         where = "WHERE programa_interes IS NOT NULL AND programa_interes != ''"
 
-    query = f"""
-        SELECT 
-            programa_interes as programa,
+    counts = """
             COUNT(*) as total,
-            COUNT(*) FILTER (WHERE resultado_gestion = 'Contacto Efectivo') as efectivos
-        FROM dim_contactos
+            COUNT(*) FILTER (WHERE resultado_gestion = 'Contacto Efectivo') as efectivos"""
+
+    if approx:
+        query = _sampled_query(counts, ["total", "efectivos"], where, group=("programa_interes", "programa"))
+    else:
+        query = f"""
+            SELECT
+                programa_interes as programa,
+                {counts}
+            FROM dim_contactos
+            {where}
+            GROUP BY programa_interes
+        """
+    query += f" ORDER BY total DESC LIMIT {limit}"
+    rows = await fetch_all(query, *args)
+    if approx:
+        for r in rows:
+            r["approx"] = _sample_meta(_scale_sample(r, ["total", "efectivos"]))
+    return rows
+
+
+async def _get_agents_approx(base: Optional[str], desde: Optional[date], hasta: Optional[date]) -> list:
+    # Merges the per-day (or all-time) HyperLogLog sketches kept by the rollup
+    # refresh instead of running COUNT(DISTINCT) over fact_contactos.
+    await ensure_rollup_tables()
+    table = "agent_day_sketches" if desde or hasta else "agent_sketch_totals"
+    base_join = ""
+    where = "WHERE 1=1"
+    args = []
+
+    if base:
+        base_join = "JOIN dim_bases b ON s.iddatabase = b.iddatabase::text"
+        args.append(base)
+        where += f" AND b.descripcion = ${len(args)}"
+    if desde:
+        args.append(desde)
+        where += f" AND s.dia >= ${len(args)}"
+    if hasta:
+        args.append(hasta)
+        where += f" AND s.dia <= ${len(args)}"
+
+    query = f"""
+        SELECT s.usuario, s.metric, s.sketch
+        FROM {table} s
+        {base_join}
         {where}
-        GROUP BY programa_interes
-        ORDER BY total DESC
-        LIMIT {limit}
     """
-    rows = await fetch_all(query, *args)
+    sketches = await fetch_all(query, *args)
+    # merging and estimating is CPU work; keep it off the event loop
+    rows = await asyncio.to_thread(_estimate_agents, sketches)
+    rows.sort(key=lambda r: r["total_leads"], reverse=True)
+    return rows[:20]
+
+
+def _estimate_agents(sketches: list) -> list:
+    blobs = defaultdict(lambda: defaultdict(list))
+    for r in sketches:
+        blobs[r["usuario"]][r["metric"]].append(r["sketch"])
+
+    rows = []
+    for usuario, by_metric in blobs.items():
+        row = {"usuario": usuario}
+        errors = {}
+        for metric in AGENT_METRICS:
+            sketch = HyperLogLog.from_bytes(union_bytes(by_metric[metric])) if by_metric.get(metric) else None
+            estimate = sketch.estimate() if sketch else 0
+            row[metric] = estimate
+            errors[metric] = round(APPROX_Z * (sketch.relative_error if sketch else 0) * estimate)
+        row["approx"] = {"method": "hyperloglog", "confidence": 0.95, "errors": errors}
+        rows.append(row)
     return rows
 
 
-@router.get("/agents")
+@router.get("/agents", dependencies=[Depends(query_budget("heavy", HEAVY_TIMEOUT_MS))])
 async def get_agents(
     base: Optional[str] = Query(None),
+    desde: Optional[date] = Query(None),
+    hasta: Optional[date] = Query(None),
+    approx: bool = Query(False),
     _user: str = Depends(require_auth),
 ):
+    if approx:
+        return await _get_agents_approx(base, desde, hasta)
+
     # Agents are processed from fact_contactos
     base_join = ""
     where = "WHERE f.usuario IS NOT NULL AND f.usuario != ''"
@@ -169,6 +347,12 @@ async def get_agents(
         base_join = "JOIN dim_bases b ON f.iddatabase = b.iddatabase"
         where += " AND b.descripcion = $1"
         args.append(base)
+    if desde:
+        args.append(desde)
+        where += f" AND NULLIF(f.fecha::text, '')::date >= ${len(args)}"
+    if hasta:
+        args.append(hasta)
+        where += f" AND NULLIF(f.fecha::text, '')::date <= ${len(args)}"
 
     query = f"""
         SELECT 
@@ -190,6 +374,56 @@ async def get_agents(
     return rows
 
 
+FACET_COLUMNS = {
+    "medio": "medio",
+    "resultado_gestion": "resultado_gestion",
+    "base": "base",
+    "programa_interes": "programa_interes",
+}
+
+
+async def _get_lead_facets(where: str, args: list, medio_cond: str, resultado_cond: str) -> tuple[int, dict]:
+    # One GROUPING SETS scan returns the total plus the counts for every facet.
+    # The medio and resultado filters are applied through FILTER instead of
+    # WHERE so each of those facets still lists the values it can switch to.
+    query = f"""
+        SELECT 
+            GROUPING(medio) as g_medio,
+            GROUPING(resultado_gestion) as g_resultado_gestion,
+            GROUPING(base) as g_base,
+            GROUPING(programa_interes) as g_programa_interes,
+            medio,
+            resultado_gestion,
+            base,
+            programa_interes,
+            COUNT(*) FILTER (WHERE {medio_cond} AND {resultado_cond}) as c,
+            COUNT(*) FILTER (WHERE {resultado_cond}) as c_medio,
+            COUNT(*) FILTER (WHERE {medio_cond}) as c_resultado_gestion
+        FROM dim_contactos
+        {where}
+        GROUP BY GROUPING SETS ((), (medio), (resultado_gestion), (base), (programa_interes))
+    """
+    rows = await fetch_all(query, *args)
+
+    total = 0
+    facets = {name: [] for name in FACET_COLUMNS}
+    for r in rows:
+        grouped = [name for name in FACET_COLUMNS if r[f"g_{name}"] == 0]
+        if not grouped:
+            total = r["c"] or 0
+            continue
+        name = grouped[0]
+        value = r[FACET_COLUMNS[name]]
+        count = r.get(f"c_{name}", r["c"]) or 0
+        if value is None or value == "" or count == 0:
+            continue
+        facets[name].append({"value": value, "count": count})
+
+    for values in facets.values():
+        values.sort(key=lambda v: v["count"], reverse=True)
+    return total, facets
+
+
 @router.get("/leads")
 async def get_leads(
     page: int = Query(1, ge=1),
@@ -198,6 +432,7 @@ async def get_leads(
     medio: Optional[str] = Query(None),
     resultado: Optional[str] = Query(None),
     base: Optional[str] = Query(None),
+    facets: bool = Query(False),
     _user: str = Depends(require_auth),
 ):
     where, args = await _get_base_filter(base)
@@ -208,20 +443,41 @@ async def get_leads(
         where += f" AND (LOWER(txtnombreapellid) LIKE ${arg_idx} OR LOWER(emlmail) LIKE ${arg_idx} OR LOWER(teltelefono) LIKE ${arg_idx})"
         args.append(search_term)
         arg_idx += 1
-        
+
+    medio_cond = "TRUE"
     if medio:
-        where += f" AND medio = ${arg_idx}"
+        medio_cond = f"medio = ${arg_idx}"
         args.append(medio)
         arg_idx += 1
-        
+
+    resultado_cond = "TRUE"
     if resultado:
-        where += f" AND resultado_gestion = ${arg_idx}"
+        resultado_cond = f"resultado_gestion = ${arg_idx}"
         args.append(resultado)
         arg_idx += 1
 
-    count_query = f"SELECT COUNT(*) as c FROM dim_contactos {where}"
-    count_row = await fetch_one(count_query, *args)
-    total = count_row["c"] if count_row else 0
+    facet_counts = None
+    if facets:
+        # The empty search is what the page loads first and after every
+        # filter change, so it is served from cache.
+        cache_key = None if search else ("leads_facets", base, medio, resultado)
+        version = data_version()
+        cached = cache_get(cache_key) if cache_key else None
+        if cached is None:
+            cached = await _get_lead_facets(where, args, medio_cond, resultado_cond)
+            if cache_key:
+                cache_set(cache_key, cached, version=version)
+        total, facet_counts = cached
+
+    if medio:
+        where += f" AND {medio_cond}"
+    if resultado:
+        where += f" AND {resultado_cond}"
+
+    if facet_counts is None:
+        count_query = f"SELECT COUNT(*) as c FROM dim_contactos {where}"
+        count_row = await fetch_one(count_query, *args)
+        total = count_row["c"] if count_row else 0
 
     offset = (page - 1) * per_page
     query = f"""
@@ -244,7 +500,103 @@ async def get_leads(
     """
     rows = await fetch_all(query, *args)
     
-    return {"data": rows, "total": total, "page": page, "per_page": per_page}
+    result = {"data": rows, "total": total, "page": page, "per_page": per_page}
+    if facet_counts is not None:
+        result["facets"] = facet_counts
+    return result
+
+
+@router.get("/compare", dependencies=[Depends(query_budget("heavy", HEAVY_TIMEOUT_MS))])
+async def get_compare(
+    bases: Optional[str] = Query(None, description="Comma-separated base names; all bases when omitted"),
+    top_medios: int = Query(3, ge=1, le=20),
+    top_agents: int = Query(5, ge=0, le=20),
+    _user: str = Depends(require_auth),
+):
+    selected = sorted({b.strip() for b in bases.split(",") if b.strip()}) if bases else []
+    cache_key = ("compare", tuple(selected), top_medios, top_agents)
+    version = data_version()
+    cached = cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    where = "WHERE base IS NOT NULL"
+    args = []
+    if selected:
+        where += " AND base = ANY($1::text[])"
+        args.append(selected)
+
+    # KPIs, funnel and the medio breakdown for every base in one scan
+    query = f"""
+        SELECT 
+            GROUPING(medio) as g_medio,
+            base,
+            medio,
+            COUNT(*) as total_leads,
+            COUNT(*) FILTER (WHERE resultado_gestion IN ('Contactado', 'Contacto Efectivo')) as contactados,
+            COUNT(*) FILTER (WHERE resultado_gestion = 'No Contactado') as no_contactados,
+            COUNT(*) FILTER (WHERE resultado_gestion = 'Contacto Efectivo') as contacto_efectivo,
+            COUNT(*) FILTER (WHERE ultima_subcategoria = '116') as matriculados,
+            AVG(NULLIF(CAST(toques AS INTEGER), 0)) as avg_toques
+        FROM dim_contactos
+        {where}
+        GROUP BY GROUPING SETS ((base), (base, medio))
+    """
+    rows = await fetch_all(query, *args)
+
+    result = {}
+    medios = defaultdict(list)
+    for r in rows:
+        if r["g_medio"] == 0:
+            if r["medio"] is not None:
+                medios[r["base"]].append({"medio": r["medio"], "total": r["total_leads"], "efectivos": r["contacto_efectivo"]})
+            continue
+        result[r["base"]] = {
+            "base": r["base"],
+            "kpis": _kpis_from_row(r),
+            "funnel": _funnel_stages(r["total_leads"], r["contactados"], r["contacto_efectivo"], r["matriculados"]),
+            "top_medios": [],
+            "agents": [],
+        }
+    for base_name, values in medios.items():
+        values.sort(key=lambda v: v["total"], reverse=True)
+        if base_name in result:
+            result[base_name]["top_medios"] = values[:top_medios]
+
+    if top_agents and result:
+        agent_where = "WHERE f.usuario IS NOT NULL AND f.usuario != ''"
+        if selected:
+            agent_where += " AND b.descripcion = ANY($1::text[])"
+
+        # Single pass over the base join, ranked per base
+        agent_query = f"""
+            SELECT * FROM (
+                SELECT 
+                    b.descripcion as base,
+                    f.usuario as usuario,
+                    COUNT(DISTINCT f.idinterno) as total_leads,
+                    COUNT(DISTINCT f.idinterno) FILTER (WHERE c.resultado_gestion IN ('Contactado', 'Contacto Efectivo')) as contactados,
+                    COUNT(DISTINCT f.idinterno) FILTER (WHERE c.resultado_gestion = 'Contacto Efectivo') as contacto_efectivo,
+                    COUNT(DISTINCT f.idinterno) FILTER (WHERE c.resultado_gestion = 'No Contactado') as no_contactados,
+                    COUNT(DISTINCT f.idinterno) FILTER (WHERE c.ultima_subcategoria = '116') as matriculados,
+                    ROW_NUMBER() OVER (PARTITION BY b.descripcion ORDER BY COUNT(DISTINCT f.idinterno) DESC) as rank
+                FROM fact_contactos f
+                JOIN dim_contactos c ON f.idinterno = c.idinterno
+                JOIN dim_bases b ON f.iddatabase = b.iddatabase
+                {agent_where}
+                GROUP BY b.descripcion, f.usuario
+            ) ranked
+            WHERE rank <= {top_agents}
+            ORDER BY base, rank
+        """
+        for r in await fetch_all(agent_query, *args):
+            base_name = r.pop("base")
+            r.pop("rank")
+            if base_name in result:
+                result[base_name]["agents"].append(r)
+
+    comparison = sorted(result.values(), key=lambda b: b["base"])
+    return cache_set(cache_key, comparison, version=version)
 
 
 @router.get("/bases")
@@ -0,0 +1,224 @@
+import csv
+import io
+import json
+import asyncpg
+from fastapi import APIRouter, Depends, HTTPException, Request
+from routes.auth import require_auth
+from database import acquire, note_write
+from cache import bump_data_version
+from rollups import ensure_rollup_tables, request_refresh
+
+router = APIRouter(prefix="/api/ingest", tags=["ingest"])
+
+# Loadable tables, their columns (as produced by the n8n workflow, see
+# mock_data.py) and the key used to deduplicate and replace rows.
+TABLES = {
+    "dim_contactos": {
+        "key": "idinterno",
+        "columns": [
+            "idinterno", "medio", "txtnombreapellid", "emlmail", "teltelefono",
+            "fecfechainsercionlead", "base", "lote", "iddatabase", "fecha_creacion_lote",
+            "descrip_subcat", "descrip_cat", "fecha_ult_gestion", "fecha_a_utilizar",
+            "ultima_mejor_subcat_num", "ultima_mejor_subcat_string", "toques",
+            "resultado_gestion", "telwhatsapp", "programa_interes", "txtcarretainteres",
+            "criterio_cliente", "ultima_subcategoria",
+        ],
+    },
+    "fact_contactos": {
+        "key": "dedup_key",
+        "columns": [
+            "dedup_key", "idinterno", "idllamada", "fecha", "idventa", "campania",
+            "iddatabase", "subcategoria", "usuario", "usuario_rellamar", "rellamar",
+            "motivo_traida",
+        ],
+    },
+}
+
+CSV_TYPES = ("text/csv", "application/csv")
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+async def _lines(request: Request):
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def _ndjson_record(line: bytes, n: int, allowed: set) -> dict:
+    try:
+        row = json.loads(line)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail=f"JSON inválido en la línea {n}")
+    if not isinstance(row, dict):
+        raise HTTPException(status_code=400, detail=f"La línea {n} no es un objeto JSON")
+    unknown = [k for k in row.keys() - allowed if not k.startswith("_")]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Columnas desconocidas en la línea {n}: {', '.join(sorted(unknown))}")
+    return row
+
+
+async def _ndjson_body(request: Request, spec_columns: list):
+    """Re-encodes JSON lines as CSV so Postgres can COPY them; returns (columns, chunks).
+
+    The columns are the keys of the first record; every record must carry
+    the same ones, since missing keys and nulls cannot be told apart once
+    encoded. Empty strings and nulls both load as NULL.
+    """
+    allowed = set(spec_columns)
+    lines = _lines(request)
+    n = 0
+    first = None
+    async for line in lines:
+        n += 1
+        if line.strip():
+            first = _ndjson_record(line, n, allowed)
+            break
+    columns = [c for c in spec_columns if first is not None and c in first]
+    expected = set(columns)
+
+    async def body():
+        nonlocal n
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        if first is not None:
+            writer.writerow([first.get(c) for c in columns])
+        async for line in lines:
+            n += 1
+            if not line.strip():
+                continue
+            row = _ndjson_record(line, n, allowed)
+            if row.keys() & allowed != expected:
+                raise HTTPException(status_code=400, detail=f"La línea {n} no trae las mismas columnas que la primera")
+            writer.writerow([row.get(c) for c in columns])
+            if buf.tell() > 1 << 20:
+                yield buf.getvalue().encode("utf-8")
+                buf.seek(0)
+                buf.truncate()
+        if buf.tell():
+            yield buf.getvalue().encode("utf-8")
+
+    return columns, body()
+
+
+async def _csv_body(request: Request):
+    """Splits the header off a CSV stream; returns (columns, remaining chunks)."""
+    stream = request.stream()
+    head = b""
+    async for chunk in stream:
+        head += chunk
+        if b"\n" in head:
+            break
+    header, _, rest = head.partition(b"\n")
+    columns = next(csv.reader([header.decode("utf-8-sig").strip()]), [])
+
+    async def body():
+        if rest:
+            yield rest
+        async for chunk in stream:
+            yield chunk
+
+    return [c.strip() for c in columns], body()
+
+
+@router.post("/{table}")
+async def ingest(
+    table: str,
+    request: Request,
+    _user: str = Depends(require_auth),
+):
+    """Bulk-load an NDJSON or CSV stream into dim_contactos or fact_contactos.
+
+    Rows are COPYed into a temporary staging table, deduplicated on the
+    table key (last occurrence wins) and merged into the target in a single
+    transaction. Only the columns present in the load are written: for keys
+    already in the table the other columns keep their current values. The
+    merge deletes and re-inserts rows because the n8n-managed tables do not
+    declare unique constraints on their keys; the table lock keeps two loads
+    of the same keys from both inserting. The rollup queue triggers pick up
+    the written rows and one coalesced rollup refresh is requested.
+    """
+    spec = TABLES.get(table)
+    if not spec:
+        raise HTTPException(status_code=404, detail=f"Tabla no soportada: {table}")
+    key = spec["key"]
+
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type in CSV_TYPES:
+        columns, source = await _csv_body(request)
+        unknown = [c for c in columns if c not in spec["columns"]]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Columnas desconocidas: {', '.join(unknown)}")
+    elif content_type in NDJSON_TYPES:
+        columns, source = await _ndjson_body(request, spec["columns"])
+        if not columns:
+            return {"table": table, "received": 0, "loaded": 0, "skipped": 0}
+    else:
+        raise HTTPException(status_code=415, detail="Usa text/csv o application/x-ndjson")
+
+    if key not in columns:
+        raise HTTPException(status_code=400, detail=f"Falta la columna clave {key}")
+
+    all_columns = spec["columns"]
+    missing = [c for c in all_columns if c not in columns]
+    stage = f"stage_{table}"
+    # columns absent from the load come from the current row for the key, if any
+    merged_cols = ", ".join(f"t.{c}" if c in missing else f"s.{c}" for c in all_columns)
+    current = f"""
+        LEFT JOIN LATERAL (
+            SELECT {", ".join(missing)} FROM {table} t
+            WHERE t.{key} = s.{key}
+            ORDER BY t.ctid DESC
+            LIMIT 1
+        ) t ON TRUE
+    """ if missing else ""
+    await ensure_rollup_tables()
+
+    try:
+        async with acquire("heavy") as conn:
+            async with conn.transaction():
+                await conn.execute(f"CREATE TEMP TABLE {stage} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+                status = await conn.copy_to_table(stage, source=source, columns=columns, format="csv")
+                copied = int(status.split()[-1])
+                # blocks other loads and writers of the table until commit, but not readers
+                await conn.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+                # all CTEs see the table as it was before the delete
+                loaded = await conn.fetchval(f"""
+                    WITH incoming AS (
+                        SELECT DISTINCT ON ({key}) {", ".join(columns)}
+                        FROM {stage}
+                        WHERE {key} IS NOT NULL
+                        ORDER BY {key}, ctid DESC
+                    ),
+                    merged AS (
+                        SELECT {merged_cols}
+                        FROM incoming s
+                        {current}
+                    ),
+                    removed AS (
+                        DELETE FROM {table} t
+                        USING incoming s
+                        WHERE t.{key} = s.{key}
+                    ),
+                    inserted AS (
+                        INSERT INTO {table} ({", ".join(all_columns)})
+                        SELECT * FROM merged
+                        RETURNING 1
+                    )
+                    SELECT COUNT(*) FROM inserted
+                """)
+            if loaded:
+                await note_write(conn)
+    except (asyncpg.exceptions.DataError, asyncpg.exceptions.IntegrityConstraintViolationError) as e:
+        # bad values or malformed CSV rows are the client's, not ours
+        raise HTTPException(status_code=400, detail=f"Datos inválidos: {str(e)[:200]}")
+
+    if loaded:
+        bump_data_version()
+        request_refresh()
+
+    return {"table": table, "received": copied, "loaded": loaded, "skipped": copied - loaded}
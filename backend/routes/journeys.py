@@ -0,0 +1,152 @@
+import asyncio
+from fastapi import APIRouter, Depends, Query, HTTPException
+from typing import Optional
+from datetime import date, timedelta
+from routes.auth import require_auth
+from database import fetch_all, fetch_one, query_budget, QueryDeadlineExceeded, INTERACTIVE_TIMEOUT_MS, REFRESH_TIMEOUT_MS
+from cache import cache_get, cache_set, data_version
+from rollups import ensure_rollup_tables, refresh_all
+
+router = APIRouter(
+    prefix="/api/journeys",
+    tags=["journeys"],
+    dependencies=[Depends(query_budget("interactive", INTERACTIVE_TIMEOUT_MS))],
+)
+
+# Days after lead entry at which the cohort conversion curves are sampled.
+CURVE_DAYS = [7, 14, 30, 60, 90]
+
+
+def _journey_filter(base: Optional[str]) -> tuple[str, list]:
+    where = "WHERE 1=1"
+    args = []
+    if base:
+        where += " AND base = $1"
+        args.append(base)
+    return where, args
+
+
+@router.get("/summary")
+async def get_journey_summary(
+    base: Optional[str] = Query(None),
+    _user: str = Depends(require_auth),
+):
+    version = data_version()
+    cached = cache_get(("journey_summary", base))
+    if cached is not None:
+        return cached
+
+    await ensure_rollup_tables()
+    where, args = _journey_filter(base)
+
+    query = f"""
+        SELECT
+            COUNT(*) as total_leads,
+            COUNT(*) FILTER (WHERE touches > 0) as contactados,
+            COUNT(*) FILTER (WHERE first_effective_at IS NOT NULL) as contacto_efectivo,
+            COUNT(*) FILTER (WHERE enrolled_at IS NOT NULL) as matriculados,
+            AVG(EXTRACT(EPOCH FROM first_touch_at - fecha_lead::timestamp) / 3600) as avg_hours_to_first_contact,
+            PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM first_touch_at - fecha_lead::timestamp) / 3600) as median_hours_to_first_contact,
+            AVG(touches_to_effective) as avg_touches_to_effective,
+            AVG(touches_to_enrollment) as avg_touches_to_enrollment,
+            AVG(EXTRACT(EPOCH FROM enrolled_at - fecha_lead::timestamp) / 86400) as avg_days_to_enrollment
+        FROM lead_journeys
+        {where}
+    """
+    row = await fetch_one(query, *args) or {}
+
+    def _round(key, digits=1):
+        return round(float(row[key]), digits) if row.get(key) is not None else None
+
+    result = {
+        "total_leads": row.get("total_leads") or 0,
+        "contactados": row.get("contactados") or 0,
+        "contacto_efectivo": row.get("contacto_efectivo") or 0,
+        "matriculados": row.get("matriculados") or 0,
+        "avg_hours_to_first_contact": _round("avg_hours_to_first_contact"),
+        "median_hours_to_first_contact": _round("median_hours_to_first_contact"),
+        "avg_touches_to_effective": _round("avg_touches_to_effective"),
+        "avg_touches_to_enrollment": _round("avg_touches_to_enrollment"),
+        "avg_days_to_enrollment": _round("avg_days_to_enrollment"),
+    }
+    return cache_set(("journey_summary", base), result, version=version)
+
+
+@router.get("/cohorts")
+async def get_cohorts(
+    weeks: int = Query(12, ge=1, le=104),
+    base: Optional[str] = Query(None),
+    _user: str = Depends(require_auth),
+):
+    version = data_version()
+    cached = cache_get(("journey_cohorts", base, weeks))
+    if cached is not None:
+        return cached
+
+    await ensure_rollup_tables()
+    where, args = _journey_filter(base)
+
+    curve_cols = ",\n            ".join(
+        f"COUNT(*) FILTER (WHERE enrolled_at < fecha_lead + INTERVAL '{d} days') as matriculados_{d}d"
+        for d in CURVE_DAYS
+    )
+    query = f"""
+        SELECT
+            TO_CHAR(cohort_week, 'YYYY-MM-DD') as cohort,
+            COUNT(*) as leads,
+            COUNT(*) FILTER (WHERE touches > 0) as contactados,
+            COUNT(*) FILTER (WHERE first_effective_at IS NOT NULL) as efectivos,
+            COUNT(*) FILTER (WHERE enrolled_at IS NOT NULL) as matriculados,
+            {curve_cols}
+        FROM lead_journeys
+        {where} AND cohort_week IS NOT NULL
+        GROUP BY cohort_week
+        ORDER BY cohort_week DESC
+        LIMIT {weeks}
+    """
+    rows = await fetch_all(query, *args)
+
+    today = date.today()
+    cohorts = []
+    for r in reversed(rows):
+        leads = r["leads"] or 0
+        cohort_start = date.fromisoformat(r["cohort"])
+        cohorts.append({
+            "cohort": r["cohort"],
+            "leads": leads,
+            "contactados": r["contactados"] or 0,
+            "efectivos": r["efectivos"] or 0,
+            "matriculados": r["matriculados"] or 0,
+            # points the cohort has not reached yet are null, not partial
+            "curve": [
+                {
+                    "days": d,
+                    "matriculados": r[f"matriculados_{d}d"] or 0,
+                    "rate": round((r[f"matriculados_{d}d"] or 0) / leads * 100, 2) if leads else 0,
+                }
+                if cohort_start + timedelta(days=d) <= today
+                else {"days": d, "matriculados": None, "rate": None}
+                for d in CURVE_DAYS
+            ],
+        })
+    return cache_set(("journey_cohorts", base, weeks), cohorts, version=version)
+
+
+@router.get("/lead/{idinterno}")
+async def get_lead_journey(idinterno: str, _user: str = Depends(require_auth)):
+    await ensure_rollup_tables()
+    row = await fetch_one("SELECT * FROM lead_journeys WHERE idinterno = $1", idinterno)
+    if not row:
+        raise HTTPException(status_code=404, detail="Lead sin recorrido registrado")
+    return row
+
+
+@router.post("/refresh", dependencies=[Depends(query_budget("heavy", REFRESH_TIMEOUT_MS))])
+async def refresh(
+    full: bool = Query(False),
+    _user: str = Depends(require_auth),
+):
+    try:
+        return await refresh_all(full=full)
+    except asyncio.TimeoutError:
+        raise QueryDeadlineExceeded()
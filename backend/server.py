@@ -3,17 +3,34 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from routes.auth import router as auth_router
 from routes.dashboard import router as dashboard_router
 from routes.ai import router as ai_router
+from routes.journeys import router as journeys_router
+from routes.ingest import router as ingest_router
+from database import close_pool, start_health_checks, db_status, DatabaseBusy, QueryDeadlineExceeded
+from routes.auth import require_auth
+from rollups import refresh_loop
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_health_checks()
+    refresher = asyncio.create_task(refresh_loop())
+    yield
+    refresher.cancel()
+    await close_pool()
+
 app = FastAPI(
     title="UniandesWeb API",
     description="Dashboard API for Uniandes Contact Center",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -24,9 +41,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(DatabaseBusy)
+async def database_busy(request: Request, exc: DatabaseBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Servidor ocupado, intenta de nuevo"},
+        headers={"Retry-After": "2"},
+    )
+
+
+@app.exception_handler(QueryDeadlineExceeded)
+async def query_deadline(request: Request, exc: QueryDeadlineExceeded):
+    return JSONResponse(status_code=504, content={"detail": "La consulta excedió el tiempo límite"})
+
+
 app.include_router(auth_router)
 app.include_router(dashboard_router)
 app.include_router(ai_router)
+app.include_router(journeys_router)
+app.include_router(ingest_router)
 
 
 @app.get("/")
@@ -34,6 +67,11 @@ async def root():
     return {"status": "ok", "app": "UniandesWeb API", "mode": "database"}
 
 
+@app.get("/health/db")
+async def health_db(_user: str = Depends(require_auth)):
+    return db_status()
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("server:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,138 @@
+"""
+HyperLogLog sketches for approximate distinct counts.
+
+Sketches are mergeable (register-wise max), so per-day sketches can be
+combined into any date range and re-adding the same value is a no-op.
+With the default precision (2^14 registers) the standard error is ~0.8%.
+"""
+import hashlib
+import math
+import struct
+from collections import Counter
+
+PRECISION = 14
+
+_DENSE = b"D"
+_SPARSE = b"S"
+
+
+def _hash(value) -> int:
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def _position(value, p: int) -> tuple[int, int]:
+    h = _hash(value)
+    rest = h & ((1 << (64 - p)) - 1)
+    return h >> (64 - p), (64 - p) - rest.bit_length() + 1
+
+
+def _encode(registers: dict, p: int) -> bytes:
+    # Most per-day, per-agent sketches only touch a few registers, so they
+    # are stored as (index, rank) pairs until the dense form is smaller.
+    m = 1 << p
+    if len(registers) * 3 < m:
+        return _SPARSE + bytes([p]) + b"".join(struct.pack(">HB", i, r) for i, r in sorted(registers.items()))
+    dense = bytearray(m)
+    for i, r in registers.items():
+        dense[i] = r
+    return _DENSE + bytes([p]) + bytes(dense)
+
+
+def sketch_values(values, precision: int = PRECISION) -> bytes:
+    """Serialized sketch of values, built without allocating dense registers."""
+    registers = {}
+    for value in values:
+        idx, rank = _position(value, precision)
+        if rank > registers.get(idx, 0):
+            registers[idx] = rank
+    return _encode(registers, precision)
+
+
+def union_bytes(blobs, precision: int = PRECISION) -> bytes:
+    """Union of serialized sketches; stays sparse until the result is dense."""
+    m = 1 << precision
+    sparse, dense = {}, None
+    for data in blobs:
+        if data[1] != precision:
+            raise ValueError("Cannot merge sketches with different precision")
+        if dense is None and (data[:1] == _DENSE or len(sparse) * 3 >= m):
+            dense = bytearray(m)
+            for i, r in sparse.items():
+                dense[i] = r
+        if dense is not None and data[:1] == _DENSE:
+            dense = bytearray(map(max, dense, data[2:]))
+        elif dense is not None:
+            for i, r in struct.iter_unpack(">HB", data[2:]):
+                if r > dense[i]:
+                    dense[i] = r
+        else:
+            for i, r in struct.iter_unpack(">HB", data[2:]):
+                if r > sparse.get(i, 0):
+                    sparse[i] = r
+    if dense is not None:
+        sparse = {i: r for i, r in enumerate(dense) if r}
+    return _encode(sparse, precision)
+
+
+def _sigma(x: float) -> float:
+    if x == 1:
+        return math.inf
+    y, z = 1.0, x
+    while True:
+        x *= x
+        z_old = z
+        z += x * y
+        y += y
+        if z == z_old:
+            return z
+
+
+def _tau(x: float) -> float:
+    if x == 0 or x == 1:
+        return 0.0
+    y, z = 1.0, 1 - x
+    while True:
+        x = math.sqrt(x)
+        z_old = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == z_old:
+            return z / 3
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = PRECISION, registers: bytearray = None):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.m)
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(self.m)
+
+    def estimate(self) -> int:
+        # Ertl's improved raw estimator: unbiased over the whole range
+        # without the empirical bias tables of HLL++.
+        m = self.m
+        q = 64 - self.p
+        counts = [0] * (q + 2)
+        for r, n in Counter(self.registers).items():
+            counts[r] = n
+        if counts[0] == m:
+            return 0
+        z = m * _tau(1 - counts[q + 1] / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + counts[k])
+        z += m * _sigma(counts[0] / m)
+        return round(m * m / (2 * math.log(2) * z))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        kind, p, body = data[:1], data[1], data[2:]
+        if kind == _DENSE:
+            return cls(p, bytearray(body))
+        sketch = cls(p)
+        for i, r in struct.iter_unpack(">HB", body):
+            sketch.registers[i] = r
+        return sketch
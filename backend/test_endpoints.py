@@ -1,20 +1,58 @@
 import asyncio
 import os
 import json
-from routes.dashboard import get_kpis, get_funnel, get_trends, get_by_medio, get_by_programa, get_agents, get_leads, get_bases_list
+import httpx
+from routes.dashboard import get_kpis, get_funnel, get_trends, get_by_medio, get_by_programa, get_agents, get_leads, get_bases_list, get_compare
 from routes.ai import ai_insights, ai_predictions, ChatRequest, ai_chat
-from database import close_pool
+from routes.journeys import get_journey_summary, get_cohorts
+from routes.auth import create_token
+from database import close_pool, db_status
+from server import app
+
+
+async def test_ingest():
+    # Rejected payloads never reach the database; set TEST_INGEST_WRITE=1 to
+    # also load (and replace) a probe row in fact_contactos.
+    headers = {"Authorization": f"Bearer {create_token('test')}"}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", headers=headers) as client:
+        r = await client.post("/api/ingest/fact_contactos", content=b"{}", headers={"Content-Type": "text/plain"})
+        print("wrong content type:", r.status_code, r.json())
+        assert r.status_code == 415
+
+        r = await client.post("/api/ingest/fact_contactos", content=b"dedup_key,nope\nx,y\n", headers={"Content-Type": "text/csv"})
+        print("unknown column:", r.status_code, r.json())
+        assert r.status_code == 400
+
+        r = await client.post("/api/ingest/fact_contactos", content=b"[1]\n", headers={"Content-Type": "application/x-ndjson"})
+        print("non-object line:", r.status_code, r.json())
+        assert r.status_code == 400
+
+        r = await client.post("/api/ingest/otra_tabla", content=b"a\n", headers={"Content-Type": "text/csv"})
+        print("unknown table:", r.status_code, r.json())
+        assert r.status_code == 404
+
+        if os.getenv("TEST_INGEST_WRITE") == "1":
+            rows = [
+                {"dedup_key": "test_endpoints_probe", "idinterno": "test_endpoints_probe", "usuario": "a"},
+                {"dedup_key": "test_endpoints_probe", "idinterno": "test_endpoints_probe", "usuario": "b"},
+            ]
+            body = "\n".join(json.dumps(row) for row in rows).encode("utf-8")
+            r = await client.post("/api/ingest/fact_contactos", content=body, headers={"Content-Type": "application/x-ndjson"})
+            print("write:", r.status_code, r.json())
+            assert r.json() == {"table": "fact_contactos", "received": 2, "loaded": 1, "skipped": 1}
+
 
 async def test_all():
     try:
         print("--- Testing Dashboard ---")
         
         print("1. /kpis")
-        kpis = await get_kpis(base=None, _user="test")
+        kpis = await get_kpis(base=None, approx=False, _user="test")
         print(json.dumps(kpis, indent=2))
         
         print("\n2. /funnel")
-        funnel = await get_funnel(base=None, _user="test")
+        funnel = await get_funnel(base=None, approx=False, _user="test")
         print(json.dumps(funnel, indent=2))
         
         print("\n3. /trends (week)")
@@ -22,25 +60,52 @@ async def test_all():
         print(f"Got {len(trends)} records. First 2:", json.dumps(trends[:2], indent=2))
         
         print("\n4. /by-medio")
-        medios = await get_by_medio(base=None, _user="test")
+        medios = await get_by_medio(base=None, approx=False, _user="test")
         print(json.dumps(medios[:3], indent=2))
         
         print("\n5. /by-programa")
-        programas = await get_by_programa(base=None, limit=5, _user="test")
+        programas = await get_by_programa(base=None, limit=5, approx=False, _user="test")
         print(json.dumps(programas, indent=2))
         
         print("\n6. /agents")
-        agents = await get_agents(base=None, _user="test")
+        agents = await get_agents(base=None, desde=None, hasta=None, approx=False, _user="test")
+        print(f"Got {len(agents)} agents. First 2:", json.dumps(agents[:2], indent=2))
+
+        print("\n6b. /agents (approx)")
+        agents = await get_agents(base=None, desde=None, hasta=None, approx=True, _user="test")
         print(f"Got {len(agents)} agents. First 2:", json.dumps(agents[:2], indent=2))
         
         print("\n7. /leads")
-        leads = await get_leads(page=1, per_page=2, search=None, medio=None, resultado=None, base=None, _user="test")
+        leads = await get_leads(page=1, per_page=2, search=None, medio=None, resultado=None, base=None, facets=False, _user="test")
         print(f"Total: {leads['total']}, Page: {leads['page']}, Per Page: {leads['per_page']}")
         print("Data:", json.dumps(leads['data'], indent=2))
+
+        print("\n7b. /leads (facets)")
+        leads = await get_leads(page=1, per_page=2, search=None, medio=None, resultado="Contactado", base=None, facets=True, _user="test")
+        print(f"Total: {leads['total']}")
+        print("Facets:", json.dumps({k: v[:3] for k, v in leads['facets'].items()}, indent=2))
         
         print("\n8. /bases")
         bases = await get_bases_list(_user="test")
         print(json.dumps(bases, indent=2))
+
+        print("\n8b. /compare")
+        compare = await get_compare(bases=None, top_medios=3, top_agents=3, _user="test")
+        print(f"Got {len(compare)} bases. First:", json.dumps(compare[:1], indent=2, default=str))
+        
+        print("\n9. /journeys/summary")
+        summary = await get_journey_summary(base=None, _user="test")
+        print(json.dumps(summary, indent=2))
+
+        print("\n10. /journeys/cohorts")
+        cohorts = await get_cohorts(weeks=4, base=None, _user="test")
+        print(json.dumps(cohorts[:2], indent=2))
+        
+        print("\n11. DB nodes (set DB_REPLICA_HOSTS to route reads to replicas)")
+        print(json.dumps(db_status(), indent=2))
+        
+        print("\n12. /ingest")
+        await test_ingest()
         
         print("\n--- Testing AI ---")
         print("Insights:")
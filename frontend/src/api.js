@@ -78,6 +78,8 @@ export const api = {
     return request(`/api/dashboard/leads?${q.toString()}`);
   },
   bases: () => request('/api/dashboard/bases'),
+  compare: (bases = []) =>
+    request(`/api/dashboard/compare${bases.length ? `?bases=${encodeURIComponent(bases.join(','))}` : ''}`),
 
   // AI
   aiChat: (message, history = []) =>
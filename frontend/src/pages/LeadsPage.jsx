@@ -27,7 +27,7 @@ export default function LeadsPage() {
     const load = useCallback(async () => {
         setLoading(true);
         try {
-            const res = await api.leads({ page, search, medio, resultado });
+            const res = await api.leads({ page, search, medio, resultado, facets: true });
             setData(res);
         } catch (e) {
             console.error(e);
@@ -39,6 +39,11 @@ export default function LeadsPage() {
 
     const totalPages = Math.ceil(data.total / data.per_page) || 1;
 
+    const facetLabel = (facet, value, label) => {
+        const hit = data.facets?.[facet]?.find((f) => f.value === value);
+        return data.facets ? `${label} (${(hit?.count || 0).toLocaleString()})` : label;
+    };
+
     const handleSearch = (e) => {
         e.preventDefault();
         setPage(1);
@@ -65,11 +70,11 @@ export default function LeadsPage() {
                     className="px-4 py-3 bg-white border border-nods-border rounded-xl text-sm text-nods-text-primary font-bold outline-none focus:border-nods-accent cursor-pointer shadow-sm hover:bg-slate-50 transition-all"
                 >
                     <option value="">Todos los medios</option>
-                    <option value="Google">Google</option>
-                    <option value="Facebook">Facebook</option>
-                    <option value="Email">Email</option>
-                    <option value="whatsapp">WhatsApp</option>
-                    <option value="Otros">Otros</option>
+                    <option value="Google">{facetLabel('medio', 'Google', 'Google')}</option>
+                    <option value="Facebook">{facetLabel('medio', 'Facebook', 'Facebook')}</option>
+                    <option value="Email">{facetLabel('medio', 'Email', 'Email')}</option>
+                    <option value="whatsapp">{facetLabel('medio', 'whatsapp', 'WhatsApp')}</option>
+                    <option value="Otros">{facetLabel('medio', 'Otros', 'Otros')}</option>
                 </select>
                 <select
                     value={resultado}
@@ -77,9 +82,9 @@ export default function LeadsPage() {
                     className="px-4 py-3 bg-white border border-nods-border rounded-xl text-sm text-nods-text-primary font-bold outline-none focus:border-nods-accent cursor-pointer shadow-sm hover:bg-slate-50 transition-all"
                 >
                     <option value="">Todos los resultados</option>
-                    <option value="No Contactado">No Contactado</option>
-                    <option value="Contactado">Contactado</option>
-                    <option value="Contacto Efectivo">Contacto Efectivo</option>
+                    <option value="No Contactado">{facetLabel('resultado_gestion', 'No Contactado', 'No Contactado')}</option>
+                    <option value="Contactado">{facetLabel('resultado_gestion', 'Contactado', 'Contactado')}</option>
+                    <option value="Contacto Efectivo">{facetLabel('resultado_gestion', 'Contacto Efectivo', 'Contacto Efectivo')}</option>
                 </select>
             </form>
 